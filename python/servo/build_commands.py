@@ -24,7 +24,7 @@ from mach.decorators import (
     Command,
 )
 
-from servo.command_base import CommandBase, cd, call, check_call, BIN_SUFFIX
+from servo.command_base import CommandBase, cd, call, check_call, clear_dep_cache, BIN_SUFFIX
 from servo.util import host_triple
 
 
@@ -350,6 +350,8 @@ class MachCommands(CommandBase):
 
         status = self.call_rustup_run(["cargo", "build"] + opts, env=env, verbose=verbose)
         elapsed = time() - build_start
+        # Dependencies may have been rebuilt into new directories
+        clear_dep_cache()
 
         # Do some additional things if the build succeeded
         if status == 0:
@@ -407,5 +409,6 @@ class MachCommands(CommandBase):
         if verbose:
             opts += ["-v"]
         opts += params
+        clear_dep_cache()
         return check_call(["cargo", "clean"] + opts,
                           env=self.build_env(), cwd=self.servo_crate(), verbose=verbose)
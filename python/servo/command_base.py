@@ -7,22 +7,26 @@
 # option. This file may not be copied, modified, or distributed
 # except according to those terms.
 
-from errno import ENOENT as NO_SUCH_FILE_OR_DIRECTORY
-from glob import glob
+from distutils.spawn import find_executable
+from errno import ENOENT as NO_SUCH_FILE_OR_DIRECTORY, ENOTDIR as NOT_A_DIRECTORY
 import gzip
-import itertools
-import locale
+import io
 import os
 from os import path
 import platform
+import Queue
 import re
 import contextlib
+import copy
+import signal
+import stat
 import subprocess
 from subprocess import PIPE
 import sys
 import tarfile
+import threading
 from xml.etree.ElementTree import XML
-from servo.util import download_file
+from servo.util import delete, download_file, replace
 import urllib2
 
 from mach.registrar import Registrar
@@ -31,8 +35,14 @@ import toml
 from servo.packages import WINDOWS_MSVC as msvc_deps
 from servo.util import host_triple
 
-BIN_SUFFIX = ".exe" if sys.platform == "win32" else ""
+# The platform can't change during a mach run, so only check it once
+IS_WINDOWS = sys.platform == "win32"
+IS_MACOSX = sys.platform == "darwin"
+IS_LINUX = sys.platform.startswith("linux")
+
+BIN_SUFFIX = ".exe" if IS_WINDOWS else ""
 NIGHTLY_REPOSITORY_URL = "https://servo-builds.s3.amazonaws.com/"
+RUSTUP_VERSION_RE = re.compile(r"rustup (\d+)\.(\d+)\.(\d+)")
 
 
 @contextlib.contextmanager
@@ -46,31 +56,56 @@ def cd(new_path):
         os.chdir(previous_path)
 
 
-@contextlib.contextmanager
-def setlocale(name):
-    """Context manager for changing the current locale"""
-    saved_locale = locale.setlocale(locale.LC_ALL)
-    try:
-        yield locale.setlocale(locale.LC_ALL, name)
-    finally:
-        locale.setlocale(locale.LC_ALL, saved_locale)
+# Newest dependency build directories, keyed by (package, bin_path)
+_dep_path_cache = {}
+
+
+def clear_dep_cache():
+    """Forget the results of find_dep_path_newest, e.g. after a rebuild"""
+    _dep_path_cache.clear()
 
 
 def find_dep_path_newest(package, bin_path):
+    key = (package, bin_path)
+    if key in _dep_path_cache:
+        return _dep_path_cache[key]
     deps_path = path.join(path.split(bin_path)[0], "build")
-    candidates = []
-    with cd(deps_path):
-        for c in glob(package + '-*'):
-            candidate_path = path.join(deps_path, c)
-            if path.exists(path.join(candidate_path, "output")):
-                candidates.append(candidate_path)
-    if candidates:
-        return max(candidates, key=lambda c: path.getmtime(path.join(c, "output")))
+    newest_path = None
+    newest_mtime = None
+    for c in os.listdir(deps_path):
+        if not c.startswith(package + '-'):
+            continue
+        candidate_path = path.join(deps_path, c)
+        try:
+            mtime = os.stat(path.join(candidate_path, "output")).st_mtime
+        except OSError as e:
+            if e.errno in (NO_SUCH_FILE_OR_DIRECTORY, NOT_A_DIRECTORY):
+                continue
+            raise
+        if newest_mtime is None or mtime > newest_mtime:
+            newest_path, newest_mtime = candidate_path, mtime
+    if newest_path:
+        _dep_path_cache[key] = newest_path
+    return newest_path
+
+
+def archive_compressor(dest_archive):
+    """Return the external compressor command to use for `dest_archive`, if any.
+
+    .tar.zst archives always go through zstd, while .tar.gz archives are
+    handed to pigz when it is installed. Both are run so that their output
+    doesn't depend on the file name, timestamp or number of cores."""
+    if dest_archive.endswith(".tar.zst"):
+        if not find_executable("zstd"):
+            raise Exception("zstd is not installed, but it is required to create " + dest_archive)
+        return ["zstd", "-T0", "-19", "--no-check", "-q", "-c"]
+    if find_executable("pigz"):
+        return ["pigz", "--no-name", "-6", "-c"]
     return None
 
 
 def archive_deterministically(dir_to_archive, dest_archive, prepend_path=None):
-    """Create a .tar.gz archive in a deterministic (reproducible) manner.
+    """Create a .tar.gz (or .tar.zst) archive in a deterministic (reproducible) manner.
 
     See https://reproducible-builds.org/docs/archives/ for more details."""
 
@@ -81,31 +116,141 @@ def archive_deterministically(dir_to_archive, dest_archive, prepend_path=None):
         tarinfo.mtime = 0
         return tarinfo
 
+    def make_tarinfo(tar_file, entry, arcname, statres):
+        """Helper to build a tar entry from the lstat result gathered while
+        walking, rather than having tarfile stat every entry a second time"""
+        mode = statres.st_mode
+        tarinfo = tar_file.tarinfo()
+        tarinfo.name = os.path.splitdrive(arcname)[1].replace(os.sep, "/").lstrip("/")
+        tarinfo.mode = mode
+        if stat.S_ISREG(mode):
+            inode = (statres.st_ino, statres.st_dev)
+            if statres.st_nlink > 1 and tar_file.inodes.get(inode, tarinfo.name) != tarinfo.name:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = tar_file.inodes[inode]
+            else:
+                tarinfo.type = tarfile.REGTYPE
+                tarinfo.size = statres.st_size
+                if inode[0]:
+                    tar_file.inodes[inode] = tarinfo.name
+        elif stat.S_ISDIR(mode):
+            tarinfo.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(entry)
+        else:
+            # Leave anything more exotic to tarfile, which returns None for
+            # types it can't store
+            return tar_file.gettarinfo(entry, arcname)
+        return tarinfo
+
+    def read_ahead(contents, stop):
+        """Helper to read small regular files, in archive order, ahead of
+        the tar writer, so that disk reads overlap with compression.
+
+        Exactly one item is queued per regular file until `stop` is set."""
+        for entry, statres in file_list:
+            if stop.is_set():
+                return
+            if not stat.S_ISREG(statres.st_mode):
+                continue
+            data = None
+            if statres.st_size <= read_ahead_file_size:
+                try:
+                    with open(entry, 'rb') as f:
+                        data = f.read()
+                except Exception:
+                    # Whatever went wrong, the writer will open the file itself and report it
+                    pass
+            contents.put(data)
+
+    def write_tar(fileobj):
+        """Helper to stream the sorted entries as a tar archive into fileobj"""
+        contents = Queue.Queue(maxsize=read_ahead_files)
+        stop = threading.Event()
+        reader = threading.Thread(target=read_ahead, args=(contents, stop))
+        reader.daemon = True
+        reader.start()
+        try:
+            write_entries(fileobj, contents)
+        finally:
+            # If writing failed part way, the reader may be waiting for room in
+            # the queue. Stop it and drop what it has read, so it can finish.
+            # At most one more item is queued after this, which always fits.
+            stop.set()
+            try:
+                while True:
+                    contents.get_nowait()
+            except Queue.Empty:
+                pass
+            reader.join()
+
+    def write_entries(fileobj, contents):
+        """Helper to write the tar entries, using the contents read ahead"""
+        with tarfile.open(fileobj=fileobj, mode='w|', bufsize=buffer_size) as tar_file:
+            for entry, statres in file_list:
+                arcname = entry
+                if prepend_path is not None:
+                    arcname = os.path.normpath(os.path.join(prepend_path, arcname))
+                tarinfo = make_tarinfo(tar_file, entry, arcname, statres)
+                if tarinfo is None:
+                    # Like TarFile.add, quietly skip types tar can't store, e.g. sockets
+                    continue
+                tarinfo = reset(tarinfo)
+                data = contents.get() if stat.S_ISREG(statres.st_mode) else None
+                if not tarinfo.isreg():
+                    tar_file.addfile(tarinfo)
+                elif data is not None:
+                    tar_file.addfile(tarinfo, io.BytesIO(data))
+                else:
+                    with open(entry, 'rb') as f:
+                        tar_file.addfile(tarinfo, f)
+
     dest_archive = os.path.abspath(dest_archive)
     with cd(dir_to_archive):
         current_dir = "."
-        file_list = [current_dir]
-        for root, dirs, files in os.walk(current_dir):
-            for name in itertools.chain(dirs, files):
-                file_list.append(os.path.join(root, name))
-
-        # Sort file entries with the fixed locale
-        with setlocale('C'):
-            file_list.sort(cmp=locale.strcoll)
+        file_list = [(current_dir, os.lstat(current_dir))]
+        # Walk the tree by hand so every entry is only stat'ed once, and keep
+        # the results around for building the tar entries
+        dirs_to_scan = [current_dir]
+        while dirs_to_scan:
+            root = dirs_to_scan.pop()
+            for name in os.listdir(root):
+                entry = os.path.join(root, name)
+                statres = os.lstat(entry)
+                file_list.append((entry, statres))
+                if stat.S_ISDIR(statres.st_mode):
+                    dirs_to_scan.append(entry)
+
+        # Sort file entries bytewise, which doesn't depend on the locale
+        file_list.sort(key=lambda item: item[0])
 
         # Use a temporary file and atomic rename to avoid partially-formed
         # packaging (in case of exceptional situations like running out of disk space).
         # TODO do this in a temporary folder after #11983 is fixed
         temp_file = '{}.temp~'.format(dest_archive)
-        with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT, 0644), 'w') as out_file:
-            with gzip.GzipFile('wb', fileobj=out_file, mtime=0) as gzip_file:
-                with tarfile.open(fileobj=gzip_file, mode='w:') as tar_file:
-                    for entry in file_list:
-                        arcname = entry
-                        if prepend_path is not None:
-                            arcname = os.path.normpath(os.path.join(prepend_path, arcname))
-                        tar_file.add(entry, filter=reset, recursive=False, arcname=arcname)
-        os.rename(temp_file, dest_archive)
+        # Buffer generously on both sides of the compressor, so that deflate and
+        # the CRC see large contiguous blocks instead of one tar record at a time
+        buffer_size = 1 << 20
+        # Files up to this size are read ahead on another thread, which keeps
+        # at most read_ahead_files of them in memory. Larger ones are streamed.
+        read_ahead_file_size = 1 << 20
+        read_ahead_files = 32
+        compressor = archive_compressor(dest_archive)
+        with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT, 0644), 'wb', buffer_size) as out_file:
+            if compressor:
+                proc = subprocess.Popen(compressor, stdin=PIPE, stdout=out_file)
+                try:
+                    write_tar(proc.stdin)
+                finally:
+                    proc.stdin.close()
+                    status = proc.wait()
+                if status:
+                    raise subprocess.CalledProcessError(status, ' '.join(compressor))
+            else:
+                with gzip.GzipFile(mode='wb', compresslevel=6, fileobj=out_file, mtime=0) as gzip_file:
+                    write_tar(gzip_file)
+        replace(temp_file, dest_archive)
 
 
 def normalize_env(env):
@@ -113,6 +258,10 @@ def normalize_env(env):
     # environment variables. Here, ensure all unicode are converted to
     # binary. utf-8 is our globally assumed default. If the caller doesn't
     # want UTF-8, they shouldn't pass in a unicode instance.
+    if not any(isinstance(k, unicode) or isinstance(v, unicode) for k, v in env.iteritems()):
+        # Already binary, which is the common case, so don't copy it
+        return env
+
     normalized_env = {}
     for k, v in env.items():
         if isinstance(k, unicode):
@@ -126,6 +275,57 @@ def normalize_env(env):
     return normalized_env
 
 
+# Programs resolved by find_windows_executable, keyed by name and search directories
+_windows_executable_cache = {}
+
+
+def find_windows_executable(name, env=None, cwd=None):
+    """Resolve `name` to a program that CreateProcess can start without cmd.exe.
+
+    Like cmd.exe, this looks in the working directory and then on PATH, trying
+    the extensions listed in PATHEXT. Returns None if `name` can't be found, or
+    can only be run through a file association (e.g. a .py script)."""
+    env = env or os.environ
+    cwd = cwd or os.getcwd()
+    dirs = (cwd,)
+    if not path.dirname(name):
+        dirs += tuple(d for d in env.get("PATH", "").split(os.pathsep) if d)
+    key = (name, dirs)
+    if key in _windows_executable_cache:
+        return _windows_executable_cache[key]
+
+    if path.splitext(name)[1]:
+        names = [name]
+    else:
+        pathext = env.get("PATHEXT", ".COM;.EXE;.BAT;.CMD").split(os.pathsep)
+        names = [name + ext for ext in pathext]
+    names = [n for n in names if path.splitext(n)[1].lower() in (".com", ".exe", ".bat", ".cmd")]
+    for d in dirs:
+        for n in names:
+            candidate = path.join(d, n)
+            if path.isfile(candidate):
+                _windows_executable_cache[key] = candidate
+                return candidate
+    return None
+
+
+def resolve_command(args, kwargs):
+    """Return the `subprocess` arguments with the program resolved, and
+    whether it still has to be run through the shell.
+
+    On Windows, the shell used to be needed for PATH handling when looking
+    for the binary. Now it's only used for what CreateProcess can't start."""
+    if not IS_WINDOWS:
+        return args, False
+    command = args[0]
+    if isinstance(command, basestring):
+        return args, True
+    executable = find_windows_executable(command[0], kwargs.get('env'), kwargs.get('cwd'))
+    if executable is None:
+        return args, True
+    return ([executable] + list(command[1:]),) + args[1:], False
+
+
 def call(*args, **kwargs):
     """Wrap `subprocess.call`, printing the command if verbose=True."""
     verbose = kwargs.pop('verbose', False)
@@ -133,9 +333,8 @@ def call(*args, **kwargs):
         print(' '.join(args[0]))
     if 'env' in kwargs:
         kwargs['env'] = normalize_env(kwargs['env'])
-    # we have to use shell=True in order to get PATH handling
-    # when looking for the binary on Windows
-    return subprocess.call(*args, shell=sys.platform == 'win32', **kwargs)
+    args, shell = resolve_command(args, kwargs)
+    return subprocess.call(*args, shell=shell, **kwargs)
 
 
 def check_output(*args, **kwargs):
@@ -145,9 +344,8 @@ def check_output(*args, **kwargs):
         print(' '.join(args[0]))
     if 'env' in kwargs:
         kwargs['env'] = normalize_env(kwargs['env'])
-    # we have to use shell=True in order to get PATH handling
-    # when looking for the binary on Windows
-    return subprocess.check_output(*args, shell=sys.platform == 'win32', **kwargs)
+    args, shell = resolve_command(args, kwargs)
+    return subprocess.check_output(*args, shell=shell, **kwargs)
 
 
 def check_call(*args, **kwargs):
@@ -161,46 +359,56 @@ def check_call(*args, **kwargs):
 
     if verbose:
         print(' '.join(args[0]))
-    # we have to use shell=True in order to get PATH handling
-    # when looking for the binary on Windows
-    proc = subprocess.Popen(*args, shell=sys.platform == 'win32', **kwargs)
-    status = None
-    # Leave it to the subprocess to handle Ctrl+C. If it terminates as
-    # a result of Ctrl+C, proc.wait() will return a status code, and,
-    # we get out of the loop. If it doesn't, like e.g. gdb, we continue
-    # waiting.
-    while status is None:
-        try:
-            status = proc.wait()
-        except KeyboardInterrupt:
-            pass
+    args, shell = resolve_command(args, kwargs)
+    proc = subprocess.Popen(*args, shell=shell, **kwargs)
+    # Leave it to the subprocess to handle Ctrl+C, which the terminal
+    # delivers to it as well. Ignore SIGINT while waiting, so that if it
+    # doesn't terminate as a result, like e.g. gdb, we simply keep waiting.
+    previous_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        status = proc.wait()
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
 
     if status:
         raise subprocess.CalledProcessError(status, ' '.join(*args))
 
 
+def parse_rustup_version(version_line):
+    """Return the version in `rustup --version` output as a (major, minor, patch) tuple"""
+    # The output is normally just "rustup X.Y.Z (...)", which doesn't need a regex
+    words = version_line.split()
+    if len(words) > 1 and words[0] == "rustup":
+        try:
+            major, minor, patch = map(int, words[1].split("."))
+            return major, minor, patch
+        except ValueError:
+            pass
+    return tuple(map(int, RUSTUP_VERSION_RE.match(version_line).groups()))
+
+
 def is_windows():
-    return sys.platform == 'win32'
+    return IS_WINDOWS
 
 
 def is_macosx():
-    return sys.platform == 'darwin'
+    return IS_MACOSX
 
 
 def is_linux():
-    return sys.platform.startswith('linux')
+    return IS_LINUX
 
 
 def set_osmesa_env(bin_path, env):
     """Set proper LD_LIBRARY_PATH and DRIVE for software rendering on Linux and OSX"""
-    if is_linux():
+    if IS_LINUX:
         dep_path = find_dep_path_newest('osmesa-src', bin_path)
         if not dep_path:
             return None
         osmesa_path = path.join(dep_path, "out", "lib", "gallium")
         env["LD_LIBRARY_PATH"] = osmesa_path
         env["GALLIUM_DRIVER"] = "softpipe"
-    elif is_macosx():
+    elif IS_MACOSX:
         osmesa_dep_path = find_dep_path_newest('osmesa-src', bin_path)
         if not osmesa_dep_path:
             return None
@@ -245,12 +453,20 @@ class CommandBase(object):
         if not hasattr(self.context, "bootstrapped"):
             self.context.bootstrapped = False
 
-        config_path = path.join(context.topdir, ".servobuild")
-        if path.exists(config_path):
-            with open(config_path) as f:
-                self.config = toml.loads(f.read())
-        else:
-            self.config = {}
+        # Results of msvc_env, keyed by (target, host triple)
+        self._msvc_envs = {}
+
+        if context.topdir not in self._parsed_configs:
+            config_path = path.join(context.topdir, ".servobuild")
+            try:
+                with open(config_path) as f:
+                    self._parsed_configs[context.topdir] = toml.load(f)
+            except IOError as e:
+                if e.errno != NO_SUCH_FILE_OR_DIRECTORY:
+                    raise
+                self._parsed_configs[context.topdir] = {}
+        # The config gets filled in and modified below, so leave the cached one untouched
+        self.config = copy.deepcopy(self._parsed_configs[context.topdir])
 
         # Handle missing/default items
         self.config.setdefault("tools", {})
@@ -285,32 +501,40 @@ class CommandBase(object):
         # Set default android target
         self.handle_android_target("armv7-linux-androideabi")
 
-    _default_toolchain = None
+    # Parsed .servobuild files, keyed by top directory
+    _parsed_configs = {}
+    # Contents of rust-toolchain, keyed by top directory
+    _default_toolchains = {}
+    _rustup_version = None
+    # Shared by all instances, as the linker doesn't change within a mach run
+    _gold_present = None
 
     def toolchain(self):
         return self.default_toolchain()
 
     def default_toolchain(self):
-        if self._default_toolchain is None:
-            filename = path.join(self.context.topdir, "rust-toolchain")
+        topdir = self.context.topdir
+        if topdir not in self._default_toolchains:
+            filename = path.join(topdir, "rust-toolchain")
             with open(filename) as f:
-                self._default_toolchain = f.read().strip()
-        return self._default_toolchain
+                self._default_toolchains[topdir] = f.read().strip()
+        return self._default_toolchains[topdir]
 
     def call_rustup_run(self, args, **kwargs):
         if self.config["tools"]["use-rustup"]:
-            try:
-                version_line = subprocess.check_output(["rustup" + BIN_SUFFIX, "--version"])
-            except OSError as e:
-                if e.errno == NO_SUCH_FILE_OR_DIRECTORY:
-                    print "It looks like rustup is not installed. See instructions at " \
-                          "https://github.com/servo/servo/#setting-up-your-environment"
-                    print
-                    return 1
-                raise
-            version = tuple(map(int, re.match("rustup (\d+)\.(\d+)\.(\d+)", version_line).groups()))
-            if version < (1, 8, 0):
-                print "rustup is at version %s.%s.%s, Servo requires 1.8.0 or more recent." % version
+            if self._rustup_version is None:
+                try:
+                    version_line = subprocess.check_output(["rustup" + BIN_SUFFIX, "--version"])
+                except OSError as e:
+                    if e.errno == NO_SUCH_FILE_OR_DIRECTORY:
+                        print "It looks like rustup is not installed. See instructions at " \
+                              "https://github.com/servo/servo/#setting-up-your-environment"
+                        print
+                        return 1
+                    raise
+                self._rustup_version = parse_rustup_version(version_line)
+            if self._rustup_version < (1, 8, 0):
+                print "rustup is at version %s.%s.%s, Servo requires 1.8.0 or more recent." % self._rustup_version
                 print "Try running 'rustup self update'."
                 return 1
             toolchain = self.toolchain()
@@ -384,9 +608,9 @@ class CommandBase(object):
             sys.exit(1)
         # Will alow us to fetch the relevant builds from the nightly repository
         os_prefix = "linux"
-        if is_windows():
+        if IS_WINDOWS:
             os_prefix = "windows-msvc"
-        if is_macosx():
+        if IS_MACOSX:
             print("The nightly flag is not supported on mac yet.")
             sys.exit(1)
         nightly_date = nightly_date.strip()
@@ -443,24 +667,58 @@ class CommandBase(object):
                 destination_folder))
         else:
             print("Extracting to {} ...".format(destination_folder))
-            if is_windows():
+            if IS_WINDOWS:
                 command = 'msiexec /a {} /qn TARGETDIR={}'.format(
                     os.path.join(nightlies_folder, destination_file), destination_folder)
                 if subprocess.call(command, stdout=PIPE, stderr=PIPE) != 0:
                     print("Could not extract the nightly executable from the msi package.")
                     sys.exit(1)
+            elif find_executable("tar"):
+                # Let the system tar detect the compression and unpack natively,
+                # rather than decompressing member by member in Python
+                os.makedirs(destination_folder)
+                command = ["tar", "-xf", os.path.join(nightlies_folder, destination_file),
+                           "-C", destination_folder]
+                if subprocess.call(command) != 0:
+                    print("Could not extract the nightly archive.")
+                    delete(destination_folder)
+                    sys.exit(1)
             else:
                 with tarfile.open(os.path.join(nightlies_folder, destination_file), "r") as tar:
                     tar.extractall(destination_folder)
         bin_folder = path.join(destination_folder, "servo")
-        if is_windows():
+        if IS_WINDOWS:
             bin_folder = path.join(destination_folder, "PFiles", "Mozilla research", "Servo Tech Demo")
         return path.join(bin_folder, "servo{}".format(BIN_SUFFIX))
 
+    def msvc_env(self, target, host):
+        """Return the extra PATH entries and environment variables for building
+        with the MSVC dependencies. These only depend on the target, so they're
+        computed once per target."""
+        key = (target, host)
+        if key not in self._msvc_envs:
+            msvc_x64 = "64" if "x86_64" in (target or host) else ""
+            msvc_deps_dir = path.join(self.context.sharedir, "msvc-dependencies")
+            package_dirs = {package: path.join(msvc_deps_dir, package, msvc_deps[package])
+                            for package in ("cmake", "ninja", "openssl", "moztools")}
+
+            extra_path = [path.join(package_dirs["cmake"], "bin"),
+                          path.join(package_dirs["ninja"], "bin")]
+            env = {
+                # Link openssl
+                "OPENSSL_INCLUDE_DIR": path.join(package_dirs["openssl"], "include"),
+                "OPENSSL_LIB_DIR": path.join(package_dirs["openssl"], "lib" + msvc_x64),
+                "OPENSSL_LIBS": "libsslMD:libcryptoMD",
+                # Link moztools
+                "MOZTOOLS_PATH": path.join(package_dirs["moztools"], "bin"),
+            }
+            self._msvc_envs[key] = (extra_path, env)
+        return self._msvc_envs[key]
+
     def build_env(self, hosts_file_path=None, target=None, is_build=False, test_unit=False):
         """Return an extended environment dictionary."""
         env = os.environ.copy()
-        if sys.platform == "win32" and type(env['PATH']) == unicode:
+        if IS_WINDOWS and type(env['PATH']) == unicode:
             # On win32, the virtualenv's activate_this.py script sometimes ends up
             # turning os.environ['PATH'] into a unicode string.  This doesn't work
             # for passing env vars in to a process, so we force it back to ascii.
@@ -470,23 +728,13 @@ class CommandBase(object):
             env['PATH'] = env['PATH'].encode('ascii', 'ignore')
         extra_path = []
         extra_lib = []
-        if "msvc" in (target or host_triple()):
-            msvc_x64 = "64" if "x86_64" in (target or host_triple()) else ""
-            msvc_deps_dir = path.join(self.context.sharedir, "msvc-dependencies")
-
-            def package_dir(package):
-                return path.join(msvc_deps_dir, package, msvc_deps[package])
-
-            extra_path += [path.join(package_dir("cmake"), "bin")]
-            extra_path += [path.join(package_dir("ninja"), "bin")]
-            # Link openssl
-            env["OPENSSL_INCLUDE_DIR"] = path.join(package_dir("openssl"), "include")
-            env["OPENSSL_LIB_DIR"] = path.join(package_dir("openssl"), "lib" + msvc_x64)
-            env["OPENSSL_LIBS"] = "libsslMD:libcryptoMD"
-            # Link moztools
-            env["MOZTOOLS_PATH"] = path.join(package_dir("moztools"), "bin")
+        host = host_triple()
+        if "msvc" in (target or host):
+            msvc_path, msvc_env = self.msvc_env(target, host)
+            extra_path += msvc_path
+            env.update(msvc_env)
 
-        if is_windows():
+        if IS_WINDOWS:
             if not os.environ.get("NATIVE_WIN32_PYTHON"):
                 env["NATIVE_WIN32_PYTHON"] = sys.executable
             # Always build harfbuzz from source
@@ -501,7 +749,7 @@ class CommandBase(object):
             env["CARGO_INCREMENTAL"] = "0"
 
         if extra_lib:
-            if sys.platform == "darwin":
+            if IS_MACOSX:
                 env["DYLD_LIBRARY_PATH"] = "%s%s%s" % \
                                            (os.pathsep.join(extra_lib),
                                             os.pathsep,
@@ -546,8 +794,10 @@ class CommandBase(object):
             env['RUSTFLAGS'] = env.get('RUSTFLAGS', "") + " " + self.config["build"]["rustflags"]
 
         # Don't run the gold linker if on Windows https://github.com/servo/servo/issues/9499
-        if self.config["tools"]["rustc-with-gold"] and sys.platform != "win32":
-            if subprocess.call(['which', 'ld.gold'], stdout=PIPE, stderr=PIPE) == 0:
+        if self.config["tools"]["rustc-with-gold"] and not IS_WINDOWS:
+            if CommandBase._gold_present is None:
+                CommandBase._gold_present = find_executable('ld.gold') is not None
+            if CommandBase._gold_present:
                 env['RUSTFLAGS'] = env.get('RUSTFLAGS', "") + " -C link-args=-fuse-ld=gold"
 
         if not (self.config["build"]["ccache"] == ""):
@@ -657,16 +907,20 @@ class CommandBase(object):
         src_clobber = os.path.join(self.context.topdir, 'CLOBBER')
         target_clobber = os.path.join(target_dir, 'CLOBBER')
 
-        if not os.path.exists(target_dir):
-            os.makedirs(target_dir)
-
-        if not os.path.exists(target_clobber):
+        try:
+            target_mtime = os.stat(target_clobber).st_mtime
+        except OSError as e:
+            if e.errno != NO_SUCH_FILE_OR_DIRECTORY:
+                raise
+            if not os.path.exists(target_dir):
+                os.makedirs(target_dir)
             # Simply touch the file.
             with open(target_clobber, 'a'):
                 pass
+            target_mtime = os.stat(target_clobber).st_mtime
 
         if auto:
-            if os.path.getmtime(src_clobber) > os.path.getmtime(target_clobber):
+            if os.stat(src_clobber).st_mtime > target_mtime:
                 print('Automatically clobbering target directory: {}'.format(target_dir))
 
                 try:
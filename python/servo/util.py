@@ -49,6 +49,23 @@ def delete(path):
         os.remove(path)
 
 
+def replace(src, dst):
+    """Rename src to dst, atomically replacing dst if it exists (like Python 3's os.replace)"""
+    if sys.platform == "win32":
+        # os.rename refuses to overwrite an existing file on Windows
+        import ctypes
+        MOVEFILE_REPLACE_EXISTING = 0x1
+        encoding = sys.getfilesystemencoding()
+        if isinstance(src, bytes):
+            src = src.decode(encoding)
+        if isinstance(dst, bytes):
+            dst = dst.decode(encoding)
+        if not ctypes.windll.kernel32.MoveFileExW(src, dst, MOVEFILE_REPLACE_EXISTING):
+            raise ctypes.WinError()
+    else:
+        os.rename(src, dst)
+
+
 def host_platform():
     os_type = platform.system().lower()
     if os_type == "linux":